@@ -8,7 +8,9 @@ import logging
 # import functions from submodules here:
 from lazynwb.base import *
 from lazynwb.file_io import *
+from lazynwb.file_handlers import *
 from lazynwb.funcs import *
+from lazynwb.metadata_cache import *
 from lazynwb.dandisets import *
 
 logger = logging.getLogger(__name__)
@@ -1,19 +1,56 @@
 from __future__ import annotations
 
-import contextlib
-import dataclasses
+import concurrent.futures
 import datetime
 import enum
-from typing import Any, Iterable
+import functools
+import logging
+import re
+import typing
+from typing import Any, Callable, Iterable
 
 import h5py
 import npc_io
+import numpy as np
 import polars as pl
 import upath
-import zarr
 
+import lazynwb.file_handlers
 import lazynwb.file_io
 import lazynwb.funcs
+import lazynwb.metadata_cache
+
+if typing.TYPE_CHECKING:
+    import zarr
+
+logger = logging.getLogger(__name__)
+
+_ISO_DATETIME_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}')
+_NWB_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+def _parse_datetime(s: str) -> datetime.datetime | str:
+    """Convert an ISO 8601 string to a datetime, or return the string unchanged.
+    
+    Examples:
+        >>> _parse_datetime('2022-08-02T15:39:59+00:00')
+        datetime.datetime(2022, 8, 2, 15, 39, 59, tzinfo=datetime.timezone.utc)
+        >>> _parse_datetime('2022-08-02T15:39:59.123456Z')
+        datetime.datetime(2022, 8, 2, 15, 39, 59, 123456, tzinfo=datetime.timezone.utc)
+        >>> _parse_datetime('mouse A10')
+        'mouse A10'
+    """
+    # most strings aren't datetimes: avoid raising and catching an exception for each of them
+    if not _ISO_DATETIME_PATTERN.match(s):
+        return s
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        pass
+    # fromisoformat is stricter in older versions of Python (e.g. no 'Z' suffix)
+    try:
+        return datetime.datetime.strptime(s, _NWB_DATETIME_FORMAT)
+    except ValueError:
+        return s
 
 class LazyNWB:
     """
@@ -21,6 +58,9 @@ class LazyNWB:
 
     - initialize with a path to an NWB file or an open h5py.File, h5py.Group, or
     zarr.Group object
+    - metadata in `general` and `general/subject` is read in the background
+      on init, so that several instances can be created in a loop without waiting
+      on each file in turn
     
     Examples:
         >>> nwb = LazyNWB('s3://codeocean-s3datasetsbucket-1u41qdg42ur9/39490bff-87c9-4ef2-b408-36334e748ac6/nwb/ecephys_620264_2022-08-02_15-39-59_experiment1_recording1.nwb')
@@ -30,29 +70,53 @@ class LazyNWB:
         datetime.datetime(2022, 8, 2, 15, 39, 59, tzinfo=datetime.timezone.utc)
     """
     _file: LazyFile
+    _prefetch: concurrent.futures.Future[None]
+
+    _PREFETCH_GROUPS = ('', 'general', 'general/subject')
 
     def __init__(
         self, 
         path_or_data: npc_io.PathLike | h5py.File | h5py.Group | zarr.Group,
         fsspec_storage_options: dict[str, Any] | None = None,
+        metadata_cache: npc_io.PathLike | None = lazynwb.metadata_cache.DEFAULT_METADATA_CACHE_PATH,
+        block_size: int = lazynwb.file_handlers.DEFAULT_BLOCK_SIZE,
+        cache_size: int | None = None,
+        disk_cache: npc_io.PathLike | None = None,
+        warmup_bytes: int | None = None,
     ) -> None:
-        self._file = LazyFile(path_or_data, fsspec_storage_options)
+        self._file = LazyFile(path_or_data, fsspec_storage_options, metadata_cache, block_size, cache_size, disk_cache, warmup_bytes)
+        self._prefetch = self._file._submit_prefetch(_prefetch_scalars, self._PREFETCH_GROUPS)
 
-    @property
+    def _wait_for_prefetch(self) -> None:
+        # not `result()`: the prefetch is cancelled if the file is closed before it starts
+        concurrent.futures.wait([self._prefetch])
+
+    @functools.cached_property
+    def _root(self) -> LazyComponent:
+        self._wait_for_prefetch()
+        return LazyComponent(self._file)
+
+    @functools.cached_property
+    def _general(self) -> LazyComponent:
+        self._wait_for_prefetch()
+        return LazyComponent(self._file, 'general')
+
+    @functools.cached_property
     def subject(self) -> Subject:
+        self._wait_for_prefetch()
         return Subject(self._file, 'general/subject')
     
     @property
     def session_start_time(self) -> datetime.datetime:
-        return LazyComponent(self._file).session_start_time
+        return self._root.session_start_time
     
     @property
     def session_id(self) -> str:
-        return LazyComponent(self._file, 'general').session_id
+        return self._general.session_id
     
     @property
     def session_description(self) -> str:
-        return LazyComponent(self._file).session_description
+        return self._root.session_description
     
     @property
     def units(self) -> pl.LazyFrame:
@@ -60,27 +124,27 @@ class LazyNWB:
 
     @property
     def experiment_description(self) -> str:
-        return LazyComponent(self._file, 'general').experiment_description
+        return self._general.experiment_description
     
     @property
     def experimenter(self) -> str:
-        return LazyComponent(self._file, 'general').experimenter
+        return self._general.experimenter
     
     @property
     def lab(self) -> str:
-        return LazyComponent(self._file, 'general').lab
+        return self._general.lab
     
     @property
     def institution(self) -> str:
-        return LazyComponent(self._file, 'general').institution
+        return self._general.institution
     
     @property
     def related_publications(self) -> str:
-        return LazyComponent(self._file, 'general').related_publications
+        return self._general.related_publications
     
     @property
     def keywords(self) -> str | None:
-        k: str | Iterable[str] | None = LazyComponent(self._file, 'general').keywords
+        k: str | Iterable[str] | None = self._general.keywords
         if k is None:
             return None
         if isinstance(k, str):
@@ -89,65 +153,91 @@ class LazyNWB:
     
     @property
     def notes(self) -> str:
-        return LazyComponent(self._file, 'general').notes
+        return self._general.notes
     
     @property
     def data_collection(self) -> str:
-        return LazyComponent(self._file, 'general').data_collection
+        return self._general.data_collection
     
     @property
     def surgery(self) -> str:
-        return LazyComponent(self._file, 'general').surgery
+        return self._general.surgery
     
     @property
     def pharmacology(self) -> str:
-        return LazyComponent(self._file, 'general').pharmacology
+        return self._general.pharmacology
     
     @property
     def virus(self) -> str:
-        return LazyComponent(self._file, 'general').virus
+        return self._general.virus
     
     @property
     def source_script(self) -> str:
-        return LazyComponent(self._file, 'general').source_script
+        return self._general.source_script
     
     @property
     def source_script_file_name(self) -> str:
-        return LazyComponent(self._file, 'general').source_script_file_name
+        return self._general.source_script_file_name
     
     
     
 class LazyComponent:
+    # an instance is created per group: slots keep them small. Subclasses declare
+    # their fields as slots, which are filled from the file on first access.
+    __slots__ = ('_file', '_path')
+
+    _file: LazyFile
+    _path: str
+
     def __init__(
         self,
         file: LazyFile,
         path: str | None = None,
     ) -> None:
         self._file = file
-        if path is None:
-            path = ''
-        self._path = path.strip().strip('/')
+        self._path = (path or '').strip().strip('/')
             
     def __getattr__(self, name: str) -> Any:
+        value = self._get_value(name)
+        if name in _get_lazy_fields(type(self)):
+            # declared fields are materialized in their slot, so the file is only read once
+            setattr(self, name, value)
+        return value
+
+    def _get_value(self, name: str) -> Any:
         path = f"{self._path}/{name}" if self._path else name
-        v = self._file.get(path, None)
+        v = self._file.get_scalar(path)
         if v is None:
             return None
-        if isinstance(v[0], bytes):
-            s = v[0].decode()
-            try:
-                return datetime.datetime.fromisoformat(s)
-            except ValueError:
-                return s
         if len(v) > 1:
             return v
+        if isinstance(v[0], bytes):
+            return _parse_datetime(v[0].decode())
+        if isinstance(v[0], str):
+            return _parse_datetime(v[0])
         return v[0]
     
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self._file}, {self._path!r})"
     
+
+@functools.cache
+def _get_lazy_fields(cls: type[LazyComponent]) -> frozenset[str]:
+    """Slots declared by subclasses of LazyComponent."""
+    return frozenset(
+        name
+        for c in cls.__mro__
+        if c is not LazyComponent and issubclass(c, LazyComponent)
+        for name in c.__dict__.get('__slots__', ())
+    )
+
     
 class Subject(LazyComponent):
+    __slots__ = (
+        'age', 'age__reference', 'date_of_birth', 'description', 'genotype',
+        'sex', 'species', 'strain', 'subject_id', 'weight',
+    )
+
     age: str | None
     """The age of the subject. The ISO 8601 Duration format is recommended, e.g., “P90D” for 90 days old."""
     
@@ -186,6 +276,20 @@ class LazyFile:
     
     - initialize with a path to an NWB file or an open h5py.File, h5py.Group, or
     zarr.Group object
+    - when opened from a path, standard top-level groups (e.g. `units`,
+      `intervals`) are looked up in a background thread, so that the first
+      accesses to them don't wait on the network
+    - values of small datasets (e.g. in `general`) are cached in memory and,
+      for files opened from a path, on disk at `metadata_cache` (set to None to
+      disable)
+    - remote hdf5 files are read in blocks of `block_size` bytes (default 8 MiB),
+      up to `cache_size` bytes of which are cached (default: 64 MiB or 8 blocks,
+      whichever is larger): h5py makes many small reads, and fetching each one
+      individually is dominated by request latency (see `lazynwb.open`) - the
+      first `warmup_bytes` (default: one block) are fetched when it's opened
+    - if a `disk_cache` directory is provided (e.g.
+      `lazynwb.DEFAULT_DISK_CACHE_PATH`), blocks of remote hdf5 files are also
+      stored there, for reuse by later processes
     
     Examples:
         >>> file = LazyFile('s3://codeocean-s3datasetsbucket-1u41qdg42ur9/39490bff-87c9-4ef2-b408-36334e748ac6/nwb/ecephys_620264_2022-08-02_15-39-59_experiment1_recording1.nwb')
@@ -210,48 +314,217 @@ class LazyFile:
         HDF5 = "hdf5"
         ZARR = "zarr"
 
+    # an instance is created for every group accessed: slots keep them small
+    __slots__ = (
+        '_backend',
+        '_components',
+        '_data',
+        '_fsspec_storage_options',
+        '_holds_reference',
+        '_metadata_cache',
+        '_metadata_cache_key',
+        '_path',
+        '_prefetched_groups',
+        '_prefetches',
+        '_scalars',
+    )
+
     _path: upath.UPath | None
     _data: h5py.File | h5py.Group | zarr.Group
     _backend: HDMFBackend
+    _fsspec_storage_options: dict[str, Any]
+    _metadata_cache: npc_io.PathLike | None
+    _metadata_cache_key: str | None
+    _scalars: dict[str, list[Any]]
+    _prefetched_groups: set[str]
+    _components: dict[str, Any]
+    _prefetches: set[concurrent.futures.Future[None]]
+    _holds_reference: bool
+    """Whether `_data` was opened from a path, and is shared with other
+    instances for the same file: it's closed on exit by the last of them."""
+
+    _PREFETCH_CHILDREN = ('units', 'intervals', 'acquisition', 'processing', 'stimulus', 'general')
 
     def __init__(
         self,
         path_or_data: npc_io.PathLike | h5py.File | h5py.Group | zarr.Group,
         fsspec_storage_options: dict[str, Any] | None = None,
+        metadata_cache: npc_io.PathLike | None = lazynwb.metadata_cache.DEFAULT_METADATA_CACHE_PATH,
+        block_size: int = lazynwb.file_handlers.DEFAULT_BLOCK_SIZE,
+        cache_size: int | None = None,
+        disk_cache: npc_io.PathLike | None = None,
+        warmup_bytes: int | None = None,
     ) -> None:
-        if isinstance(path_or_data, (h5py.File, h5py.Group, zarr.Group)):
+        self._fsspec_storage_options = fsspec_storage_options or {}
+        if _is_group(path_or_data):
             self._path = None
             self._data = path_or_data
+            self._holds_reference = False
+            metadata_cache = None
         else:
-            self._path = npc_io.from_pathlike(path_or_data)
-            self._data = lazynwb.file_io.open(self._path, **(fsspec_storage_options or {}))
+            self._path = lazynwb.file_io.get_upath(path_or_data, **self._fsspec_storage_options)
+            if cache_size is None:
+                # enough blocks for readahead to be useful with large blocks
+                cache_size = max(lazynwb.file_handlers.DEFAULT_CACHE_SIZE, 8 * block_size)
+            self._data = lazynwb.file_io._open_shared(
+                self._path,
+                block_size=block_size,
+                cache_size=cache_size,
+                disk_cache=disk_cache,
+                warmup_bytes=warmup_bytes,
+                **self._fsspec_storage_options,
+            )
+            self._holds_reference = True
         self._backend = self.get_hdmf_backend()
+        self._init_caches(metadata_cache)
+        if self._path is not None:
+            # the first accesses are almost always to top-level groups: look them up
+            # in the background while the caller gets started
+            self._submit_prefetch(_prefetch_children, self._PREFETCH_CHILDREN)
+
+    @classmethod
+    def _wrap(
+        cls,
+        data: h5py.Group | zarr.Group,
+        backend: HDMFBackend,
+        prefetches: set[concurrent.futures.Future[None]],
+    ) -> LazyFile:
+        """Create an instance for a group in an already-open file, skipping the
+        checks in `__init__`.
+
+        Background tasks are tracked in the `prefetches` set of the instance
+        that owns the file, so they're all waited for when it's closed.
+        """
+        self = object.__new__(cls)
+        self._fsspec_storage_options = {}
+        self._path = None
+        self._data = data
+        self._holds_reference = False
+        self._backend = backend
+        self._init_caches(metadata_cache=None)
+        self._prefetches = prefetches
+        return self
+
+    def _init_caches(self, metadata_cache: npc_io.PathLike | None) -> None:
+        self._metadata_cache = metadata_cache
+        self._metadata_cache_key = None
+        self._scalars = {}
+        self._prefetched_groups = set()
+        self._components = {}
+        self._prefetches = set()
+
+    def _submit_prefetch(self, fn: Callable[..., None], *args: Any) -> concurrent.futures.Future[None]:
+        """Run `fn(self, *args)` in the background. Pending tasks are waited
+        for (or cancelled) when the file is closed."""
+        future = lazynwb.file_io.get_threadpool_executor().submit(fn, self, *args)
+        self._prefetches.add(future)
+        future.add_done_callback(self._prefetches.discard)
+        return future
 
     def get_hdmf_backend(self) -> HDMFBackend:
         if isinstance(self._data, (h5py.File, h5py.Group)):
             return self.HDMFBackend.HDF5
-        elif isinstance(self._data, zarr.Group):
+        elif lazynwb.file_io.is_zarr_group(self._data):
             return self.HDMFBackend.ZARR
         raise ValueError(f"Unknown backend for {self._data!r}")
 
     def __getattr__(self, name) -> Any:
-        # for built-in properties/methods of the underlying h5py/zarr object:
-        with contextlib.suppress(AttributeError):
-            return getattr(self._data, name)
-        
+        # components are looked up in the file once, then cached:
+        component = self._components.get(name, _MISSING)
+        if component is not _MISSING:
+            return component
+        data = self._data
         # for components of the NWB file:
-        with contextlib.suppress(KeyError):
-            component = self._data[name]
-            # provide a new instance of the class for conveninet access to components:
-            #! this is now slower than using __getitem__ directly
-            if isinstance(component, (h5py.Group, zarr.Group)):
-                return LazyFile(component)
+        if name in data:
+            component = self._cache_component(name, data[name])
+            if not isinstance(component, LazyFile):
+                # datasets that are normally used together with this one are
+                # likely to be accessed next: start reading them in the background
+                companions = [c for c in _get_companions(name) if c not in self._components]
+                if companions:
+                    self._submit_prefetch(_prefetch_components, companions)
             return component
+        # for built-in properties/methods of the underlying h5py/zarr object:
+        attr = getattr(data, name, _MISSING)
+        if attr is not _MISSING:
+            # `name` isn't a component, so the check above won't change on the
+            # next access (files are read-only): skip it by caching the attribute
+            self._components[name] = attr
+            return attr
         raise AttributeError(f"No attribute named {name!r} in NWB file")
 
+    def _cache_component(self, name: str, component: Any) -> Any:
+        if name in self._components:
+            return self._components[name]
+        if _is_group(component):
+            # provide an instance of the class for convenient access to components
+            component = LazyFile._wrap(component, self._backend, self._prefetches)
+        # may be called concurrently from a prefetch thread: keep the first instance
+        return self._components.setdefault(name, component)
+
     def __getitem__(self, name) -> Any:
         return self._data[name]
 
+    def get_scalar(self, path: str) -> Any:
+        """
+        Get the values of a small dataset as a list (with bytes decoded to str),
+        or the dataset itself if it's too large to be cached. Returns None if the
+        dataset doesn't exist.
+        
+        - on first access, all small datasets in the same group are read
+          together (see `prefetch_scalars`)
+        """
+        path = path.strip('/')
+        group = path.rpartition('/')[0]
+        self.prefetch_scalars(group)
+        if path in self._scalars:
+            return self._scalars[path]
+        return self._data.get(path, None)
+
+    def prefetch_scalars(self, group: str = '') -> None:
+        """
+        Read the values of all small datasets in a group and cache them.
+        
+        - if the on-disk metadata cache is enabled, values are read from it when
+          available for this version of the file, otherwise they're read from the
+          file then written to the cache
+        """
+        group = group.strip('/')
+        if group in self._prefetched_groups:
+            return
+        if self._metadata_cache is not None and self._metadata_cache_key is None:
+            self._read_metadata_cache()
+            if group in self._prefetched_groups:
+                return
+        node = self._data.get(group, None) if group else self._data
+        if _is_group(node):
+            for name, component in node.items():
+                if not (isinstance(component, h5py.Dataset) or lazynwb.file_io.is_zarr_array(component)):
+                    continue
+                values = _get_scalar_values(component)
+                if values is not None:
+                    self._scalars[f"{group}/{name}" if group else name] = values
+        self._prefetched_groups.add(group)
+        if self._metadata_cache_key is not None:
+            lazynwb.metadata_cache.write_metadata_cache(
+                key=self._metadata_cache_key,
+                data={'groups': sorted(self._prefetched_groups), 'scalars': self._scalars},
+                cache_path=self._metadata_cache,
+            )
+
+    def _read_metadata_cache(self) -> None:
+        assert self._path is not None and self._metadata_cache is not None
+        key = lazynwb.metadata_cache.get_metadata_cache_key(self._path, **self._fsspec_storage_options)
+        if key is None:
+            # version of file can't be determined: don't use the cache
+            self._metadata_cache = None
+            return
+        self._metadata_cache_key = key
+        data = lazynwb.metadata_cache.read_metadata_cache(key, self._metadata_cache)
+        if data is not None:
+            self._scalars.update(data['scalars'])
+            self._prefetched_groups.update(data['groups'])
+
     def __contains__(self, name) -> bool:
         return name in self._data
 
@@ -267,11 +540,115 @@ class LazyFile:
         return self
 
     def __exit__(self, *args, **kwargs) -> None:
-        if self._path is not None:
-            if isinstance(self._data, h5py.File):
-                self._data.close()
-            elif isinstance(self._data, zarr.Group):
-                self._data.store.close()
+        """
+        >>> import tempfile
+        >>> path = f"{tempfile.mkdtemp()}/test.nwb"
+        >>> with h5py.File(path, 'w') as f:
+        ...     _ = f.create_group('units')
+        >>> a = LazyFile(path, metadata_cache=None)
+        >>> b = LazyFile(path, metadata_cache=None)
+        >>> a._data is b._data
+        True
+        >>> with a:
+        ...     pass
+        >>> 'units' in b    # still open for `b`
+        True
+        >>> with b:
+        ...     pass
+        >>> bool(b._data.id.valid)
+        False
+        """
+        # background reads must finish before the file is closed, or they'd fail
+        # against it (and could refill the caches after they're cleared)
+        pending = list(self._prefetches)
+        for future in pending:
+            future.cancel()
+        concurrent.futures.wait(pending)
+        self._components.clear()
+        if self._holds_reference:
+            # other instances for the same path share the open file: it's only
+            # closed when the last of them exits
+            self._holds_reference = False
+            lazynwb.file_io._release(self._data)
+
+_MISSING = object()
+
+def _prefetch_scalars(file: LazyFile, groups: Iterable[str]) -> None:
+    # failures are not raised here: values will be read individually on access instead
+    try:
+        for group in groups:
+            file.prefetch_scalars(group)
+    except Exception as exc:
+        _log_prefetch_failure(file, 'metadata', exc)
+
+def _prefetch_children(file: LazyFile, names: Iterable[str]) -> None:
+    # failures are not raised here: groups will be looked up again on access
+    try:
+        for name in names:
+            component = file._data.get(name, None)
+            if _is_group(component):
+                file._cache_component(name, component)
+    except Exception as exc:
+        _log_prefetch_failure(file, 'groups', exc)
+
+def _log_prefetch_failure(file: LazyFile, what: str, exc: Exception) -> None:
+    # the file may be closed (e.g. elsewhere, by a LazyFile sharing it) while a
+    # prefetch is running: that's expected, and not worth a warning
+    level = logging.WARNING if lazynwb.file_io._is_open(file._data) else logging.DEBUG
+    logger.log(level, f"failed to prefetch {what} from {file}: {exc!r}")
+
+_COMPANIONS: dict[str, tuple[str, ...]] = {
+    'spike_times': ('id',),
+    'start_time': ('stop_time',),
+    'stop_time': ('start_time',),
+}
+"""Datasets that are normally accessed together with a dataset of the same
+group, in addition to the `_index` dataset of a ragged column."""
+
+def _get_companions(name: str) -> tuple[str, ...]:
+    """
+    >>> _get_companions('spike_times')
+    ('id', 'spike_times_index')
+    >>> _get_companions('spike_times_index')
+    ('spike_times',)
+    """
+    if name.endswith('_index'):
+        return (*_COMPANIONS.get(name, ()), name.removesuffix('_index'))
+    return (*_COMPANIONS.get(name, ()), f"{name}_index")
+
+def _prefetch_components(file: LazyFile, names: Iterable[str]) -> None:
+    """Look up datasets and read their first element, so that the metadata and
+    first chunk of each are cached before they're accessed."""
+    # failures are not raised here: datasets will be read again on access
+    try:
+        for name in names:
+            component = file._data.get(name, None)
+            if component is None or _is_group(component):
+                continue
+            file._cache_component(name, component)
+            if component.ndim and component.size:
+                component[:1]
+    except Exception as exc:
+        logger.debug(f"failed to prefetch datasets from {file}: {exc!r}")
+
+def _is_group(obj: Any) -> bool:
+    return isinstance(obj, h5py.Group) or lazynwb.file_io.is_zarr_group(obj)
+
+_MAX_SCALAR_SIZE = 100
+
+def _get_scalar_values(data: h5py.Dataset | zarr.Array) -> list[Any] | None:
+    """Read a small 0- or 1-D dataset as a list of json-serializable values, or
+    return None if it's not suitable for caching."""
+    if data.ndim > 1 or data.size > _MAX_SCALAR_SIZE:
+        return None
+    values = np.atleast_1d(data[()]).tolist()
+    try:
+        values = [v.decode() if isinstance(v, bytes) else v for v in values]
+    except UnicodeDecodeError:
+        return None
+    if not values or not all(isinstance(v, (str, int, float, bool)) for v in values):
+        return None
+    return values
 
 if __name__ == "__main__":
     from npc_io import testmod
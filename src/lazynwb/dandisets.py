@@ -1,36 +1,48 @@
 from __future__ import annotations
 
+import collections
+import concurrent.futures
 import os
+import typing
 from collections.abc import Generator
 
-import dandi.dandiapi
-
+import lazynwb.file_io
 from lazynwb.base import LazyFile
 
+if typing.TYPE_CHECKING:
+    import dandi.dandiapi
+
 
 def get_dandi_client(token: str | None = None) -> dandi.dandiapi.DandiAPIClient:
+    # imported here as it's slow to import and only needed for accessing Dandisets
+    import dandi.dandiapi
+
     if token is None:
         token = os.getenv("DANDI_API_TOKEN", default=None)
     return dandi.dandiapi.DandiAPIClient(token=token)
 
+_MAX_PENDING_OPENS = 16
+
 def get_dandiset_nwbs(dandiset_id: str, version_id: str | None = None) -> Generator[LazyFile, None, None]:
     """Get a LazyFile object for each file in the specified Dandiset.
+
+    - files are opened concurrently in a thread pool
     
     >>> next(get_dandiset_nwbs('000363'))           # ephys dataset from the Svoboda Lab
     LazyFile('https://dandiarchive.s3.amazonaws.com/blobs/56c/31a/56c31a1f-a6fb-4b73-ab7d-98fb5ef9a553')
     """
-    # assets = get_dandiset_assets(dandiset_id, version_id)
-    # def _helper(asset) -> LazyFile:
-    #     return LazyFile(asset.get_content_url(follow_redirects=1, strip_query=True))
-    # future_to_nwb: dict[concurrent.futures.Future, LazyFile] = {}
-    # with concurrent.futures.ThreadPoolExecutor(max_workers=6) as pool:
-    #     for asset in assets:
-    #         pool.submit(_helper, asset)
-    # for future in concurrent.futures.as_completed(future_to_nwb):
-    #     yield future.result()
+    # resolving urls and opening files is dominated by network latency, so assets
+    # are processed concurrently - results are still yielded in asset order, and
+    # only a limited number are opened ahead of the consumer
     assets = get_dandiset_assets(dandiset_id, version_id)
+    executor = lazynwb.file_io.get_threadpool_executor()
+    futures: collections.deque[concurrent.futures.Future[LazyFile]] = collections.deque()
     for asset in assets:
-        yield get_lazynwb_from_dandiset_asset(asset)
+        futures.append(executor.submit(get_lazynwb_from_dandiset_asset, asset))
+        if len(futures) > _MAX_PENDING_OPENS:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
 
 def get_lazynwb_from_dandiset_asset(asset: dandi.dandiapi.BaseRemoteAsset) -> LazyFile:
     return LazyFile(asset.get_content_url(follow_redirects=1, strip_query=False))
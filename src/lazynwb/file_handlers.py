@@ -0,0 +1,461 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from collections.abc import Callable, Hashable
+from typing import Any, BinaryIO
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 8 * 1024**2
+DEFAULT_CACHE_SIZE = 64 * 1024**2
+DEFAULT_PREFETCH_DEPTH = 4
+DEFAULT_RETAINED_SIZE = 256 * 1024**2
+DEFAULT_DISK_CACHE_PATH = '~/.cache/lazynwb/blocks'
+DEFAULT_DISK_CACHE_SIZE = 10 * 1024**3
+MAX_RANGE_REQUESTS = 8
+MIN_RANGE_REQUEST_SIZE = 1024**2
+
+
+class CachingRemoteReader(io.RawIOBase):
+    """
+    A read-only file-like object that wraps a seekable binary file (e.g. from
+    fsspec or remfile) and caches fixed-size blocks of its contents.
+
+    - h5py makes many small reads when accessing a file: these are served from
+      cached blocks, instead of each requiring a separate request
+    - contiguous runs of missing blocks are fetched with a single read
+    - when the cache exceeds `cache_size` bytes, least-recently used blocks are
+      evicted
+    - implements `readinto`, so data is copied directly into the caller's buffer
+    - when blocks are read sequentially, the blocks that follow are fetched in a
+      background thread, so network latency overlaps with processing of the
+      current block: the number fetched ahead doubles while access remains
+      sequential, up to `prefetch_depth`
+    - if `cache_key` is provided (e.g. the file's url), cached blocks are retained
+      when the reader is closed, and used by the next reader created with the
+      same key, block size and file size - up to `DEFAULT_RETAINED_SIZE` bytes in
+      total are retained across all files
+    - if `cache_key` and a `disk_cache` are provided, blocks are also stored on
+      disk, so they can be read locally by later processes: `cache_key` must
+      then identify the version of the file (e.g. include its ETag), so that
+      blocks of a file that has since been replaced aren't used
+    - if `read_range(start, end)` is provided (a thread-safe function that
+      returns bytes `start` to `end` of the file, e.g. fsspec's `cat_file`), it's
+      used instead of the file object, and reads spanning several blocks are
+      split into up to `MAX_RANGE_REQUESTS` requests, made concurrently - each
+      of at least `MIN_RANGE_REQUEST_SIZE` bytes, so small blocks are still
+      fetched together
+
+    Examples:
+        >>> reader = CachingRemoteReader(io.BytesIO(bytes(range(100))), block_size=16, cache_size=32)
+        >>> _ = reader.seek(10)
+        >>> reader.read(10)
+        b'\\n\\x0b\\x0c\\r\\x0e\\x0f\\x10\\x11\\x12\\x13'
+        >>> sorted(reader._blocks)  # both blocks were fetched with one read
+        [0, 1]
+        >>> _ = reader.seek(-4, io.SEEK_END)
+        >>> reader.read()
+        b'`abc'
+        >>> sorted(reader._blocks)  # oldest block evicted
+        [1, 6]
+
+        >>> reader = CachingRemoteReader(io.BytesIO(bytes(100)), block_size=16, prefetch_depth=2)
+        >>> for _ in range(3):
+        ...     _ = reader.read(16)
+        >>> sorted(reader._pending)  # sequential reads: next block is being fetched
+        [3]
+        >>> _ = reader.read(16)
+        >>> sorted(reader._pending)  # still sequential: read further ahead, in one request
+        [4, 5]
+        >>> reader._pending[4] is reader._pending[5]
+        True
+        >>> _ = reader.seek(0)
+        >>> _ = reader.read(1)
+        >>> sorted(reader._pending)
+        []
+
+        >>> reader = CachingRemoteReader(io.BytesIO(bytes(100)), block_size=16, cache_key='file.nwb')
+        >>> _ = reader.read(16)
+        >>> reader.close()
+        >>> sorted(CachingRemoteReader(io.BytesIO(bytes(100)), block_size=16, cache_key='file.nwb')._blocks)
+        [0]
+
+        >>> data = bytes(range(100))
+        >>> reader = CachingRemoteReader(io.BytesIO(data), block_size=16, read_range=lambda start, end: data[start:end])
+        >>> reader.read(40) == data[:40]
+        True
+
+        >>> requests = []
+        >>> reader = CachingRemoteReader(io.BytesIO(bytes(2**24)), block_size=4096, read_range=lambda start, end: requests.append(end - start) or bytes(end - start))
+        >>> reader.cache_range(0, 8 * 1024**2)
+        >>> len(reader._blocks), len(requests), min(requests)
+        (2048, 8, 1048576)
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO | Any,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        prefetch_depth: int = DEFAULT_PREFETCH_DEPTH,
+        cache_key: Hashable | None = None,
+        disk_cache: DiskBlockCache | None = None,
+        read_range: Callable[[int, int], bytes] | None = None,
+    ) -> None:
+        super().__init__()
+        self._file = file
+        self._read_range = read_range
+        self.block_size = block_size
+        self.max_blocks = max(1, cache_size // block_size)
+        self.prefetch_depth = prefetch_depth
+        self._size = file.seek(0, io.SEEK_END)
+        self._retain_key = None if cache_key is None else (cache_key, block_size, self._size)
+        self._blocks: collections.OrderedDict[int, bytes] = _pop_retained_blocks(self._retain_key)
+        self._disk_cache = disk_cache if cache_key is not None else None
+        self._pos = 0
+        # the underlying file is shared with the prefetch thread:
+        self._file_lock = threading.Lock()
+        self._pending: dict[int, concurrent.futures.Future[dict[int, bytes]]] = {}
+        self._recent_blocks: collections.deque[int] = collections.deque(maxlen=3)
+        self._readahead = 0
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence!r}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer: Any) -> int:
+        view = memoryview(buffer).cast('B')
+        start = self._pos
+        stop = min(start + len(view), self._size)
+        if start >= stop:
+            return 0
+        first = start // self.block_size
+        last = (stop - 1) // self.block_size
+        blocks = self._get_blocks(first, last)
+        self._update_prefetch(last)
+        written = 0
+        for index, block in enumerate(blocks, start=first):
+            block_start = index * self.block_size
+            lo = max(start, block_start) - block_start
+            hi = min(stop, block_start + len(block)) - block_start
+            view[written:written + hi - lo] = block[lo:hi]
+            written += hi - lo
+        self._pos += written
+        return written
+
+    def cache_range(self, start: int, stop: int) -> None:
+        """Fetch the blocks covering bytes `start` to `stop` into the cache, with
+        a single read for any that are missing.
+
+        >>> reader = CachingRemoteReader(io.BytesIO(bytes(100)), block_size=16)
+        >>> reader.cache_range(0, 40)
+        >>> sorted(reader._blocks)
+        [0, 1, 2]
+        """
+        stop = min(stop, self._size)
+        if start < stop:
+            self._get_blocks(start // self.block_size, (stop - 1) // self.block_size)
+
+    def _get_blocks(self, first: int, last: int) -> list[bytes]:
+        """Get blocks `first` to `last` (inclusive), from the cache or the file."""
+        blocks: dict[int, bytes] = {}
+        missing: list[int] = []
+        for index in range(first, last + 1):
+            if index in self._blocks:
+                self._blocks.move_to_end(index)
+                blocks[index] = self._blocks[index]
+            elif index in self._pending:
+                blocks[index] = self._pending.pop(index).result()[index]
+                self._blocks[index] = blocks[index]
+            else:
+                missing.append(index)
+        if missing:
+            blocks.update(self._load_blocks(missing))
+        for index in missing:
+            self._blocks[index] = blocks[index]
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return [blocks[index] for index in range(first, last + 1)]
+
+    def _update_prefetch(self, index: int) -> None:
+        """Record the last block accessed and, if the access pattern is
+        sequential, start fetching the blocks that follow it."""
+        if self.prefetch_depth < 1:
+            return
+        if self._recent_blocks and self._recent_blocks[-1] == index:
+            return
+        self._recent_blocks.append(index)
+        recent = list(self._recent_blocks)
+        is_sequential = (
+            len(recent) == self._recent_blocks.maxlen
+            and all(a < b for a, b in zip(recent, recent[1:]))
+        )
+        if not is_sequential:
+            # access is no longer sequential: blocks being prefetched are unlikely to be needed
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self._readahead = 0
+            return
+        # read further ahead the longer access stays sequential, up to `prefetch_depth`
+        self._readahead = min(self.prefetch_depth, max(1, 2 * self._readahead))
+        to_fetch = [
+            next_index
+            for next_index in range(index + 1, index + 1 + self._readahead)
+            if next_index * self.block_size < self._size
+            and next_index not in self._blocks
+            and next_index not in self._pending
+        ]
+        if not to_fetch:
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # contiguous blocks are fetched together, with one read
+        for run_first, run_last in _get_runs(to_fetch):
+            run = list(range(run_first, run_last + 1))
+            future = self._executor.submit(self._load_blocks, run)
+            for next_index in run:
+                self._pending[next_index] = future
+
+    def _load_blocks(self, indices: list[int]) -> dict[int, bytes]:
+        """Get blocks that aren't in memory from the disk cache, or the file."""
+        blocks: dict[int, bytes] = {}
+        if self._disk_cache is None:
+            to_read = indices
+        else:
+            to_read = []
+            for index in indices:
+                block = self._disk_cache.get(self._retain_key, index)
+                if block is None:
+                    to_read.append(index)
+                else:
+                    blocks[index] = block
+        for run_first, run_last in _get_runs(to_read):
+            run = self._read_blocks(run_first, run_last)
+            if self._disk_cache is not None:
+                for index, block in run.items():
+                    self._disk_cache.put(self._retain_key, index, block)
+            blocks.update(run)
+        return blocks
+
+    def _read_blocks(self, first: int, last: int) -> dict[int, bytes]:
+        if self._read_range is not None:
+            # several requests in parallel have higher throughput than one large
+            # request, but each has a fixed cost: use a few, of a reasonable size
+            per_request = max(
+                -(-(last - first + 1) // MAX_RANGE_REQUESTS),
+                -(-MIN_RANGE_REQUEST_SIZE // self.block_size),
+            )
+            if last - first < per_request:
+                return self._read_range_blocks(first, last)
+            futures = [
+                _get_range_executor().submit(
+                    self._read_range_blocks, start, min(start + per_request - 1, last)
+                )
+                for start in range(first, last + 1, per_request)
+            ]
+            blocks: dict[int, bytes] = {}
+            for future in futures:
+                blocks.update(future.result())
+            return blocks
+        with self._file_lock:
+            self._file.seek(first * self.block_size)
+            data = self._file.read((last - first + 1) * self.block_size)
+        return self._split_blocks(data, first, last)
+
+    def _read_range_blocks(self, first: int, last: int) -> dict[int, bytes]:
+        assert self._read_range is not None
+        start = first * self.block_size
+        data = self._read_range(start, min((last + 1) * self.block_size, self._size))
+        return self._split_blocks(data, first, last)
+
+    def _split_blocks(self, data: bytes, first: int, last: int) -> dict[int, bytes]:
+        return {
+            index: data[(index - first) * self.block_size:(index - first + 1) * self.block_size]
+            for index in range(first, last + 1)
+        }
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            self._pending.clear()
+            _retain_blocks(self._retain_key, self._blocks)
+            self._blocks = collections.OrderedDict()
+            self._file.close()
+        super().close()
+
+
+@functools.cache
+def _get_range_executor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(max_workers=MAX_RANGE_REQUESTS, thread_name_prefix="lazynwb-range")
+
+
+class DiskBlockCache:
+    """
+    Blocks of files stored on local disk, so they persist across processes.
+
+    - each block is a separate file, in a two-level directory tree derived from a
+      hash of the file's key (e.g. url, block size and file size)
+    - blocks are written atomically, so concurrent processes can share a cache
+    - when more than `max_size` bytes are stored, the least-recently used blocks
+      are deleted (checked after every `max_size / 10` bytes written)
+
+    Examples:
+        >>> import tempfile
+        >>> cache = DiskBlockCache(tempfile.mkdtemp())
+        >>> cache.put(('file.nwb', 16, 100), 0, b'data')
+        >>> cache.get(('file.nwb', 16, 100), 0)
+        b'data'
+        >>> cache.get(('file.nwb', 16, 100), 1) is None
+        True
+    """
+
+    def __init__(self, path: str | os.PathLike, max_size: int = DEFAULT_DISK_CACHE_SIZE) -> None:
+        self.path = os.path.expanduser(os.fspath(path))
+        self.max_size = max_size
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def _get_block_path(self, key: Hashable, index: int) -> str:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:4], f"{digest[4:]}_{index}")
+
+    def get(self, key: Hashable, index: int) -> bytes | None:
+        block_path = self._get_block_path(key, index)
+        try:
+            with open(block_path, 'rb') as f:
+                data = f.read()
+            os.utime(block_path)  # mark as recently used
+        except OSError:
+            return None
+        return data
+
+    def put(self, key: Hashable, index: int, data: bytes) -> None:
+        """Store a block. Failures are logged but not raised: the cache is an
+        optimization only."""
+        block_path = self._get_block_path(key, index)
+        try:
+            os.makedirs(os.path.dirname(block_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(block_path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, block_path)
+        except OSError as exc:
+            logger.warning(f"failed to write block to disk cache at {self.path}: {exc!r}")
+            return
+        with self._lock:
+            self._written += len(data)
+            if self._written < self.max_size // 10:
+                return
+            self._written = 0
+        self._evict()
+
+    def _evict(self) -> None:
+        entries: list[tuple[float, int, str]] = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                block_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(block_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, block_path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, block_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(block_path)
+            total -= size
+
+
+@functools.cache
+def get_disk_block_cache(path: str = DEFAULT_DISK_CACHE_PATH, max_size: int = DEFAULT_DISK_CACHE_SIZE) -> DiskBlockCache:
+    """Get a disk cache instance shared by all readers using the same directory."""
+    return DiskBlockCache(path, max_size)
+
+
+_retained: collections.OrderedDict[Hashable, collections.OrderedDict[int, bytes]] = collections.OrderedDict()
+_retained_lock = threading.Lock()
+
+
+def _pop_retained_blocks(key: Hashable | None) -> collections.OrderedDict[int, bytes]:
+    """Take the blocks retained from a closed reader with the same key, if any.
+
+    >>> _retain_blocks('a', collections.OrderedDict({0: b'x'}))
+    >>> dict(_pop_retained_blocks('a'))
+    {0: b'x'}
+    >>> dict(_pop_retained_blocks('a'))
+    {}
+    """
+    if key is not None:
+        with _retained_lock:
+            blocks = _retained.pop(key, None)
+        if blocks is not None:
+            return blocks
+    return collections.OrderedDict()
+
+
+def _retain_blocks(key: Hashable | None, blocks: collections.OrderedDict[int, bytes]) -> None:
+    """Keep the blocks from a closed reader for reuse, evicting blocks of the
+    least-recently closed files to stay within `DEFAULT_RETAINED_SIZE`."""
+    if key is None or not blocks:
+        return
+    with _retained_lock:
+        _retained[key] = blocks
+        _retained.move_to_end(key)
+        total = sum(len(b) for retained in _retained.values() for b in retained.values())
+        while total > DEFAULT_RETAINED_SIZE and _retained:
+            _, evicted = _retained.popitem(last=False)
+            total -= sum(len(b) for b in evicted.values())
+
+
+def _get_runs(indices: list[int]) -> list[tuple[int, int]]:
+    """Group sorted integers into (first, last) runs of consecutive values.
+
+    >>> _get_runs([1, 2, 3, 5, 7, 8])
+    [(1, 3), (5, 5), (7, 8)]
+    """
+    runs: list[tuple[int, int]] = []
+    for index in indices:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
+
+
+if __name__ == "__main__":
+    from npc_io import testmod
+
+    testmod()
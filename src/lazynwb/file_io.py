@@ -1,47 +1,503 @@
 from __future__ import annotations
 
+import concurrent.futures
 import contextlib
+import functools
+import os
+import re
+import sys
+import threading
+import typing
 from typing import Any
 
+import fsspec
 import h5py
 import npc_io
 import remfile
 import upath
-import zarr
 
+import lazynwb.metadata_cache
+from lazynwb.file_handlers import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_CACHE_SIZE,
+    CachingRemoteReader,
+    get_disk_block_cache,
+)
 
-def open(path: npc_io.PathLike, use_remfile: bool = False, **fsspec_storage_options: Any) -> h5py.File | zarr.Group:
+if typing.TYPE_CHECKING:
+    import zarr
+
+
+def open(
+    path: npc_io.PathLike | h5py.Group | zarr.Group,
+    format: typing.Literal['hdf5', 'zarr'] | None = None,
+    use_remfile: bool = False,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    warmup_bytes: int | None = None,
+    rdcc_nbytes: int | None = None,
+    rdcc_nslots: int | None = None,
+    disk_cache: npc_io.PathLike | None = None,
+    **fsspec_storage_options: Any,
+) -> h5py.File | zarr.Group:
     """
     Open a file that meets the NWB spec, minimizing the amount of data/metadata read.
 
     - file is opened in read-only mode
+    - an already-open h5py or zarr object is returned unchanged
+    - `format` is inferred from unambiguous file extensions (.zarr, .h5,
+      .hdf5): otherwise, or if it isn't specified, it's determined by trying to
+      open the file
     - file is not closed when the function returns
     - currently supports NWB files saved in .hdf5 and .zarr format
+    - remote hdf5 files are read in blocks of `block_size` bytes, up to
+      `cache_size` bytes of which are cached: h5py makes many small reads, and
+      fetching each one individually is dominated by request latency
+    - the first `warmup_bytes` (default: `block_size`) of a remote hdf5 file
+      are fetched before h5py reads the superblock and root group, which are
+      near the start of the file
+    - for remote paths, the format is determined by reading the first 8 bytes
+      (the hdf5 signature) and is remembered for subsequent opens of the same
+      path
+    - each call returns a new file object, which the caller is responsible for
+      closing: cached blocks of remote hdf5 files are retained after it's closed
+      or garbage-collected, so opening the same file again is fast (see
+      `CachingRemoteReader`)
+    - hdf5 files are opened with a larger chunk cache than h5py's default (1
+      MiB), set by `rdcc_nbytes` and `rdcc_nslots`: the defaults are larger for
+      remote files, where re-reading an evicted chunk is expensive
+    - if a `disk_cache` directory is provided (e.g.
+      `lazynwb.DEFAULT_DISK_CACHE_PATH`), blocks of remote hdf5 files are also
+      stored there, up to `DEFAULT_DISK_CACHE_SIZE` bytes, so they can be read
+      locally by later processes - blocks are stored with the file's ETag (or
+      modification time), and not at all if it isn't available
+    - hdf5 files also get a larger metadata cache, so object headers and b-tree
+      nodes aren't evicted and read again
 
     Examples:
         >>> nwb = open('https://dandiarchive.s3.amazonaws.com/blobs/f78/fe2/f78fe2a6-3dc9-4c12-a288-fbf31ce6fc1c')
         >>> nwb = open('https://dandiarchive.s3.amazonaws.com/blobs/f78/fe2/f78fe2a6-3dc9-4c12-a288-fbf31ce6fc1c', use_remfile=False)
         >>> nwb = open('s3://codeocean-s3datasetsbucket-1u41qdg42ur9/39490bff-87c9-4ef2-b408-36334e748ac6/nwb/ecephys_620264_2022-08-02_15-39-59_experiment1_recording1.nwb')
     """
-    path = npc_io.from_pathlike(path)
-    if path.protocol == "s3":
-        fsspec_storage_options.setdefault('anon', True)
-    path = upath.UPath(path, **fsspec_storage_options)
-    
+    if isinstance(path, h5py.Group) or is_zarr_group(path):
+        return path
+    path = get_upath(path, **fsspec_storage_options)
+    if format is None:
+        format = _get_format_from_suffix(path)
+    return _open(
+        path,
+        format,
+        use_remfile=use_remfile,
+        block_size=block_size,
+        cache_size=cache_size,
+        warmup_bytes=warmup_bytes,
+        rdcc_nbytes=rdcc_nbytes,
+        rdcc_nslots=rdcc_nslots,
+        disk_cache=disk_cache,
+    )
+
+
+_shared_files: dict[tuple, h5py.File | zarr.Group] = {}
+"""Files opened with `_open_shared`, by path and options, while they have holders."""
+_references: dict[int, int] = {}
+"""Number of holders of each file opened with `_open_shared`, by object id."""
+_shared_files_lock = threading.Lock()
+
+
+def _open_shared(path: npc_io.PathLike, **open_kwargs: Any) -> h5py.File | zarr.Group:
+    """Open a file with `open()` and register a reference to it, which must be
+    released with `_release`. Files opened with the same path and options are
+    shared by their holders: the file is closed when the last reference is
+    released.
+
+    - files returned by `open()` itself are never shared, so closing one doesn't
+      affect any other holder
+
+    Examples:
+        >>> import tempfile
+        >>> path = f"{tempfile.mkdtemp()}/test.h5"
+        >>> h5py.File(path, 'w').close()
+        >>> a = _open_shared(path)
+        >>> b = _open_shared(path)
+        >>> a is b
+        True
+        >>> open(path) is a
+        False
+        >>> _release(a)
+        >>> bool(b.id.valid)     # still open for the other holder
+        True
+        >>> _release(b)
+        >>> bool(b.id.valid)
+        False
+    """
+    upath_ = get_upath(path)
+    key: tuple | None = (
+        upath_.as_posix(),
+        tuple(sorted(upath_.storage_options.items())),
+        tuple(sorted(open_kwargs.items())),
+    )
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable options: don't share
+        key = None
+    if key is not None:
+        with _shared_files_lock:
+            file = _shared_files.get(key)
+            if file is not None and _is_open(file):
+                _references[id(file)] += 1
+                return file
+    file = open(path, **open_kwargs)
+    with _shared_files_lock:
+        shared = _shared_files.get(key) if key is not None else None
+        if shared is not None and _is_open(shared):
+            # opened concurrently in another thread: use the first one
+            _close(file)
+            file = shared
+        elif key is not None:
+            _shared_files[key] = file
+        _references[id(file)] = _references.get(id(file), 0) + 1
+    return file
+
+
+def _release(file: h5py.File | zarr.Group) -> None:
+    """Release a reference to a file obtained with `_open_shared`, closing it if
+    it was the last one."""
+    with _shared_files_lock:
+        count = _references.pop(id(file), 0) - 1
+        if count > 0:
+            _references[id(file)] = count
+            return
+        # closed files must not be shared again
+        for key in [k for k, v in _shared_files.items() if v is file]:
+            del _shared_files[key]
+    _close(file)
+
+
+def _close(file: h5py.File | zarr.Group) -> None:
+    if isinstance(file, h5py.File):
+        file.close()
+    elif is_zarr_group(file):
+        file.store.close()
+
+
+def clear_open_cache() -> None:
+    """Forget all files shared between `LazyFile` instances, so that subsequent
+    instances open them again. Files are not closed."""
+    with _shared_files_lock:
+        _shared_files.clear()
+
+
+def _is_open(file: h5py.Group | zarr.Group) -> bool:
+    # zarr groups have no open/closed state
+    return bool(file.id.valid) if isinstance(file, h5py.Group) else True
+
+
+def _open(path: upath.UPath, format: typing.Literal['hdf5', 'zarr'] | None, **hdf5_options: Any) -> h5py.File | zarr.Group:
+    open_hdf5 = functools.partial(_open_hdf5, path, **hdf5_options)
+    if format == 'zarr':
+        return _open_zarr(path)
+    if format == 'hdf5':
+        return open_hdf5()
+
+    if _is_remote_path(path):
+        # the format of a remote path can't be determined from its name: check for
+        # the hdf5 signature with a single small read, then remember the result
+        url = path.as_posix()
+        hdmf_format = _url_to_format.get(url)
+        if hdmf_format == 'zarr':
+            return _open_zarr(path)
+        if hdmf_format == 'hdf5' or _has_hdf5_signature(path):
+            file = open_hdf5()
+            _url_to_format[url] = 'hdf5'
+            return file
+        # an hdf5 file with a user block has its signature at a later offset, so
+        # fall back to hdf5 if the path isn't a zarr store
+        with contextlib.suppress(OSError, KeyError, ValueError):
+            file = _open_zarr(path)
+            _url_to_format[url] = 'zarr'
+            return file
+        file = open_hdf5()
+        _url_to_format[url] = 'hdf5'
+        return file
+
+    # local hdf5 files can be identified cheaply, without trying (and importing) zarr
+    if h5py.is_hdf5(path.path):
+        return open_hdf5()
+
     # zarr ------------------------------------------------------------- #
     # there's no file-name convention for what is a zarr file, so we have to try opening it and see if it works
     # - zarr.open() is fast regardless of size
-    with contextlib.suppress(Exception):
-        return zarr.open(store=path, mode="r")
+    # - only errors from a path not being a zarr store are suppressed (zarr's
+    #   errors are ValueErrors): anything else is raised rather than masked by
+    #   the hdf5 attempt below
+    with contextlib.suppress(OSError, KeyError, ValueError):
+        return _open_zarr(path)
 
     # hdf5 ------------------------------------------------------------- #
-    if not use_remfile:
-        # conventional method is open the file with fsspec and then pass the file handle to h5py:
-        file = path.open(mode="rb", cache_type="first")
+    return open_hdf5()
+
+
+_SUFFIX_TO_FORMAT: dict[str, typing.Literal['hdf5', 'zarr']] = {'.zarr': 'zarr', '.h5': 'hdf5', '.hdf5': 'hdf5'}
+
+
+def _get_format_from_suffix(path: upath.UPath) -> typing.Literal['hdf5', 'zarr'] | None:
+    """Get the format of a file from its extension, if it's unambiguous.
+
+    - '.nwb' is used for both formats, so isn't considered
+
+    >>> _get_format_from_suffix(upath.UPath('s3://bucket/session.nwb.zarr/'))
+    'zarr'
+    >>> _get_format_from_suffix(upath.UPath('/data/session.nwb')) is None
+    True
+    """
+    return _SUFFIX_TO_FORMAT.get(path.suffix.lower())
+
+
+_url_to_format: dict[str, typing.Literal['hdf5', 'zarr']] = {}
+"""Format of each remote path opened successfully, so subsequent opens don't need
+to be checked."""
+
+
+_HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def _has_hdf5_signature(path: upath.UPath) -> bool:
+    """Check whether a remote file starts with the hdf5 signature, reading only
+    its first 8 bytes."""
+    try:
+        head = get_filesystem(path).cat_file(path.path, start=0, end=len(_HDF5_SIGNATURE))
+    except (OSError, ValueError):
+        # e.g. a zarr store, which is a directory
+        return False
+    return head == _HDF5_SIGNATURE
+
+
+def _open_zarr(path: upath.UPath) -> zarr.Group:
+    import zarr
+
+    # zarr only accepts its own stores or strings: a url is opened with fsspec
+    kwargs = {'storage_options': path.storage_options} if _is_remote_path(path) else {}
+    # consolidated metadata for the whole hierarchy (written by hdmf-zarr by
+    # default) is read with one request, instead of one per group and array
+    try:
+        return zarr.open_consolidated(store=path.as_posix(), mode="r", **kwargs)
+    except KeyError:
+        # no .zmetadata
+        return zarr.open(store=path.as_posix(), mode="r", **kwargs)
+
+
+def _open_hdf5(
+    path: upath.UPath,
+    use_remfile: bool = False,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    warmup_bytes: int | None = None,
+    rdcc_nbytes: int | None = None,
+    rdcc_nslots: int | None = None,
+    disk_cache: npc_io.PathLike | None = None,
+) -> h5py.File:
+    is_remote = _is_remote_path(path)
+    chunk_cache = dict(
+        rdcc_nbytes=rdcc_nbytes or (_REMOTE_RDCC_NBYTES if is_remote else _LOCAL_RDCC_NBYTES),
+        rdcc_nslots=rdcc_nslots or _RDCC_NSLOTS,
+    )
+    if not is_remote and not use_remfile:
+        return _open_local_hdf5(path.path, **chunk_cache)
+    if use_remfile:
+        # remfile can be slightly faster in practice for the initial opening:
+        # - remfile makes plain http requests, so s3 urls are converted
+        file = remfile.File(url=_s3_to_http(path.as_posix()))
+        read_range = None
     else:
-        # but using remfile is slightly faster in practice, at least for the initial opening:
-        file = remfile.File(url=path.as_posix())
-    return h5py.File(file, mode="r")
+        # conventional method is open the file with fsspec and then pass the file handle to h5py:
+        # - caching is disabled here, as blocks are cached by the reader below
+        fs = get_filesystem(path)
+        file = fs.open(path.path, mode="rb", cache_type="none")
+        # - blocks are read with stateless range requests, so several can be made at once
+        read_range = functools.partial(_cat_range, fs, path.path)
+    cache_key = path.as_posix()
+    block_cache = None
+    if disk_cache is not None:
+        # blocks on disk outlive this process, and are only valid for the current
+        # version of the file: if that can't be determined, they aren't stored
+        version_key = lazynwb.metadata_cache.get_metadata_cache_key(path)
+        if version_key is not None:
+            cache_key = version_key
+            block_cache = get_disk_block_cache(os.fspath(disk_cache))
+    # large blocks are cached, so small reads from h5py rarely need a new request
+    # - blocks are kept after the file is closed, for reuse if it's opened again
+    reader = CachingRemoteReader(
+        file,
+        block_size=block_size,
+        cache_size=cache_size,
+        cache_key=cache_key,
+        disk_cache=block_cache,
+        read_range=read_range,
+    )
+    # the metadata h5py reads first is at the start of the file:
+    reader.cache_range(0, block_size if warmup_bytes is None else warmup_bytes)
+    file = h5py.File(reader, mode="r", **chunk_cache)
+    # a file-like object can't be opened with a custom file access property list,
+    # so the metadata cache is configured on the open file instead
+    _configure_metadata_cache(file.id)
+    return file
+
+
+def _open_local_hdf5(filename: str, rdcc_nbytes: int, rdcc_nslots: int) -> h5py.File:
+    """Open a local file by name, so reads go through HDF5's native file driver
+    instead of a Python file object, with its chunk and metadata caches
+    configured in a file access property list."""
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fclose_degree(h5py.h5f.CLOSE_STRONG)
+    fapl.set_cache(0, rdcc_nslots, rdcc_nbytes, 0.75)
+    _configure_metadata_cache(fapl)
+    return h5py.File(h5py.h5f.open(os.fsencode(filename), h5py.h5f.ACC_RDONLY, fapl=fapl))
+
+
+def _cat_range(fs: fsspec.AbstractFileSystem, path: str, start: int, end: int) -> bytes:
+    return fs.cat_file(path, start=start, end=end)
+
+
+_LOCAL_RDCC_NBYTES = 16 * 1024**2
+_REMOTE_RDCC_NBYTES = 128 * 1024**2
+_RDCC_NSLOTS = 10007  # prime, ~100x the number of chunks that fit in the cache
+
+
+def _configure_metadata_cache(target: h5py.h5f.FileID | h5py.h5p.PropFAID) -> None:
+    """Start the metadata cache of an open file or file access property list at a
+    larger size than the default, and keep entries for the maximum number of
+    epochs before they're considered for eviction: NWB files are browsed by
+    walking many groups, whose object headers and b-tree nodes are re-read if
+    evicted."""
+    config = target.get_mdc_config()
+    config.set_initial_size = True
+    config.initial_size = 16 * 1024**2
+    config.max_size = 64 * 1024**2
+    config.epochs_before_eviction = 10  # max allowed by HDF5
+    target.set_mdc_config(config)
+
+
+_S3_URL_PATTERN = re.compile(r"^s3://([^/]+)/(.+)$")
+
+
+@functools.lru_cache(maxsize=256)
+def _s3_to_http(url: str) -> str:
+    """Convert an s3 url to the equivalent public https url; other urls are
+    returned unchanged.
+
+    >>> _s3_to_http('s3://bucket/dir/file.nwb')
+    'https://bucket.s3.amazonaws.com/dir/file.nwb'
+    >>> _s3_to_http('https://bucket.s3.amazonaws.com/dir/file.nwb')
+    'https://bucket.s3.amazonaws.com/dir/file.nwb'
+    >>> _s3_to_http('s3://bucket')  # no key: not a file
+    's3://bucket'
+    """
+    match = _S3_URL_PATTERN.match(url)
+    if match is None:
+        return url
+    return f"https://{match[1]}.s3.amazonaws.com/{match[2]}"
+
+
+def get_upath(path: npc_io.PathLike, **fsspec_storage_options: Any) -> upath.UPath:
+    """Normalize a path to a UPath, with default storage options for the protocol applied.
+    
+    - anonymous access is used for S3 unless specified otherwise
+    - UPaths created from strings are cached, as constructing them is relatively
+      slow and the same path is often normalized repeatedly (os.PathLike objects
+      are converted to str first)
+
+    >>> get_upath('s3://bucket/file.nwb') is get_upath('s3://bucket/file.nwb')
+    True
+    >>> get_upath('s3://bucket/file.nwb').storage_options['anon']
+    True
+    """
+    if not isinstance(path, upath.UPath) and hasattr(path, '__fspath__'):
+        # e.g. pathlib.Path: use the str for the cache lookup
+        path = os.fspath(path)
+    if isinstance(path, str):
+        options_key = tuple(sorted(fsspec_storage_options.items()))
+        try:
+            hash(options_key)
+        except TypeError:
+            pass
+        else:
+            return _get_upath_from_str(path, options_key)
+    return _get_upath(path, **fsspec_storage_options)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_upath_from_str(path: str, options_key: tuple[tuple[str, Any], ...]) -> upath.UPath:
+    return _get_upath(path, **dict(options_key))
+
+
+def _get_upath(path: npc_io.PathLike, **fsspec_storage_options: Any) -> upath.UPath:
+    path = npc_io.from_pathlike(path)
+    if path.protocol == "s3":
+        fsspec_storage_options.setdefault('anon', True)
+    if all(path.storage_options.get(k) == v for k, v in fsspec_storage_options.items()):
+        # avoid constructing a second UPath when there's nothing to add (e.g. an
+        # already-normalized path)
+        return path
+    return upath.UPath(path, **fsspec_storage_options)
+
+
+def get_filesystem(path: upath.UPath) -> fsspec.AbstractFileSystem:
+    """Get the fsspec filesystem for a path, shared by all paths with the same
+    protocol and storage options, so that its connection pool (e.g. for S3 or
+    HTTP) is reused across files.
+
+    >>> get_filesystem(upath.UPath('s3://a/1.nwb', anon=True)) is get_filesystem(upath.UPath('s3://b/2.nwb', anon=True))
+    True
+    """
+    options_key = tuple(sorted(path.storage_options.items()))
+    try:
+        return _get_filesystem(path.protocol, options_key)
+    except TypeError:
+        # unhashable storage options
+        return path.fs
+
+
+@functools.lru_cache(maxsize=None)
+def _get_filesystem(protocol: str, options_key: tuple[tuple[str, Any], ...]) -> fsspec.AbstractFileSystem:
+    return fsspec.filesystem(protocol, **dict(options_key))
+
+
+_LOCAL_PROTOCOLS = frozenset(('', 'file', 'local'))
+
+
+def _is_remote_path(path: upath.UPath) -> bool:
+    """Check if a path needs to be accessed over a network, based on its protocol
+    alone (the path itself isn't accessed).
+
+    >>> _is_remote_path(upath.UPath('s3://bucket/file.nwb'))
+    True
+    >>> _is_remote_path(upath.UPath('/data/file.nwb'))
+    False
+    >>> _is_remote_path(upath.UPath('file:///data/file.nwb'))
+    False
+    """
+    return path.protocol not in _LOCAL_PROTOCOLS
+
+
+@functools.cache
+def get_threadpool_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Get a thread pool shared across the package, created on first use."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="lazynwb")
+
+
+def is_zarr_group(obj: Any) -> bool:
+    """Check if `obj` is a zarr.Group, without importing zarr: if it hasn't
+    been imported yet, `obj` can't be a zarr object."""
+    zarr = sys.modules.get('zarr')
+    # zarr may be partially imported, by a file being opened in another thread
+    return zarr is not None and isinstance(obj, getattr(zarr, 'Group', ()))
+
+
+def is_zarr_array(obj: Any) -> bool:
+    """Check if `obj` is a zarr.Array, without importing zarr."""
+    zarr = sys.modules.get('zarr')
+    return zarr is not None and isinstance(obj, getattr(zarr, 'Array', ()))
 
 
 if __name__ == "__main__":
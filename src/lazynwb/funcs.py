@@ -1,19 +1,25 @@
 from __future__ import annotations
 
 import concurrent.futures
-import contextlib
+import functools
 import logging
 import time
+import weakref
 from collections.abc import Generator, Iterable
 from typing import Any
 import typing
 
 import h5py
+import numpy as np
+import numpy.typing as npt
 import polars as pl
-import zarr
-from polars.type_aliases import PolarsDataType, PythonDataType
+
+import lazynwb.file_handlers
+import lazynwb.file_io
 
 if typing.TYPE_CHECKING:
+    import zarr
+
     from lazynwb.base import LazyFile
 
 logger = logging.getLogger(__name__)
@@ -34,25 +40,36 @@ def get_units(nwb: LazyFile) -> pl.LazyFrame:
         <LazyFrame [38 cols, {"amplitude_cutoff": Float64 … "waveform_sd": List(Float64)}] at 0x7FC93DB97490>
         
     """
-    data = _get_units_column_data(nwb, use_thread_pool=isinstance(nwb.units, zarr.Group))
+    use_thread_pool = lazynwb.file_io.is_zarr_group(nwb['units'])
+    data = _get_units_column_data(nwb, use_thread_pool=use_thread_pool)
     data = {k: data[k] for k in _get_filtered_units_column_names(data.keys())}
-    generator_data = {k: _get_data_generator(v) for k, v in data.items()}
+    # whole columns are read with one call each, rather than row-by-row as polars
+    # iterates over them
+    if use_thread_pool:
+        # zarr fetches and decompresses chunks without holding the GIL: read
+        # columns concurrently
+        values = list(_get_column_executor().map(_read_column, data.values()))
+    else:
+        values = [_read_column(v) for v in data.values()]
+    column_data = {k: _get_column_values(v) for k, v in zip(data, values)}
     _overrides = {k: _get_polars_schema_override(data[k]) for k in data}
     schema_overrides = {k: v for k, v in _overrides.items() if v is not None}
     t0 = time.time()
-    lf = pl.LazyFrame(data=generator_data, infer_schema_length=10, schema_overrides=schema_overrides)
+    lf = pl.LazyFrame(data=column_data, schema_overrides=schema_overrides)
     logger.warning(f"initialized units LazyFrame from {nwb._data} in {time.time() - t0:.2f} s")
     return lf
 
 def _get_filtered_units_column_names(names: Iterable[str]) -> Generator[str, None, None]:
+    """
+    >>> list(_get_filtered_units_column_names(['amplitude', 'spike_times', 'spike_times_index', 'waveforms', 'waveforms_index', 'obs_intervals']))
+    ['amplitude']
+    """
     names = tuple(names)
-    for name in names:
-        if name in ("spike_times", "obs_intervals"):
-            continue
-        # skip indexed columns:
-        if name.endswith("_index") or f"{name}_index" in names:
-            continue
-        yield name
+    # indexed columns and their index columns are skipped: excluded names are
+    # found in a single pass, rather than searching all names for each one
+    index_names = {name for name in names if name.endswith("_index")}
+    excluded = {"spike_times", "obs_intervals"} | index_names | {name.removesuffix("_index") for name in index_names}
+    yield from (name for name in names if name not in excluded)
 
 def _get_units_column_data(nwb: LazyFile, use_thread_pool: bool = False) -> dict[str, zarr.Array | h5py.Dataset]:
     """Get the units table as a dict of zarr.Array or h5py.Dataset objects. 
@@ -60,26 +77,79 @@ def _get_units_column_data(nwb: LazyFile, use_thread_pool: bool = False) -> dict
     Optionally use a thread pool to speed up retrieval of the columns - faster for zarr files.
     """
     data: dict[str, zarr.Array | h5py.Dataset] = {}
+    # the underlying group is used directly, rather than going through
+    # `LazyFile.__getattr__` for each column
+    units = nwb['units']
     t0 = time.time()
     if use_thread_pool:
-        future_to_column = {}
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            future_to_column = {pool.submit(nwb.units.get, column_name): column_name for column_name in nwb.units}
-        for future in concurrent.futures.as_completed(future_to_column):
-            column_name = future_to_column[future]
-            data[column_name] = future.result()
+        # results are collected in submission order: cheaper than `as_completed`, and
+        # columns keep the order they have in the file
+        column_names = list(units)
+        data = dict(zip(column_names, _get_column_executor().map(units.get, column_names)))
     else:
-        data = {column_name: nwb.units.get(column_name) for column_name in nwb.units}
+        data = {column_name: units.get(column_name) for column_name in units}
     logger.warning(f"retrieved units columns from {nwb._data} in {time.time() - t0:.2f} s ({use_thread_pool=})")
     return data
 
+@functools.cache
+def _get_column_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Thread pool for concurrent reads within a table, created on first use.
+
+    - separate from the package-wide pool, which may be busy opening files (e.g.
+      from a Dandiset) or prefetching: reads that a caller is waiting on don't
+      queue behind that work
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="lazynwb-columns")
+
+def _read_column(data: h5py.Dataset | zarr.Array) -> npt.NDArray:
+    return data[:]
+
 def _get_polars_schema_override(data: zarr.Array | h5py.Dataset) -> pl.DataType | None:
     if data.dtype.kind == 'O' or 'name' in data.name.split('/')[-1]:
         return pl.String()
     return None
 
-def _get_data_generator(data: h5py.Dataset | zarr.Array) -> Generator[PolarsDataType | PythonDataType, None, None]:
-    yield from iter(data)
+def _get_column_values(values: npt.NDArray) -> npt.NDArray | list[npt.NDArray]:
+    """Prepare the values read from a column for polars.
+
+    - strings are decoded together, rather than row by row
+    - multi-dimensional columns (e.g. waveforms) are split into one array per
+      row, giving a List column
+
+    >>> _get_column_values(np.array([b'probeA', b'probeB'])).tolist()
+    ['probeA', 'probeB']
+    >>> len(_get_column_values(np.zeros((3, 2))))
+    3
+    """
+    if values.dtype.kind in 'OS':
+        return _decode_strings(values)
+    if values.ndim > 1:
+        return list(values)
+    return values
+
+def _decode_strings(values: npt.NDArray) -> npt.NDArray:
+    """Decode an array of bytes (e.g. HDF5 strings) to str.
+
+    - fixed-length bytes are converted in a single vectorized call
+    - variable-length values are decoded once per unique value: string columns
+      are often categorical (e.g. electrode group names)
+
+    >>> _decode_strings(np.array([b'probeA', b'probeB', b'probeA'], dtype=object)).tolist()
+    ['probeA', 'probeB', 'probeA']
+    >>> _decode_strings(np.array([b'probeA', b'probeB'])).tolist()
+    ['probeA', 'probeB']
+    """
+    if values.dtype.kind == 'S':
+        return np.char.decode(values, 'utf-8')
+    if values.dtype.kind != 'O' or not len(values) or values.ndim != 1:
+        return values
+    try:
+        unique, inverse = np.unique(values, return_inverse=True)
+    except TypeError:
+        # mixed/unorderable types
+        return values
+    decoded = np.array([v.decode() if isinstance(v, bytes) else v for v in unique], dtype=object)
+    return decoded[inverse]
 
 
 def get_spike_times(nwb: LazyFile, unit_idx: int) -> Any:
@@ -104,21 +174,169 @@ def get_obs_intervals(nwb: LazyFile, unit_idx: int) -> tuple[tuple[float, float]
         >>> get_obs_intervals(nwb, 0) # column does not exist: returns None
         
     """
-    with contextlib.suppress(KeyError):
-        return get_indexed_units_column(nwb, "obs_intervals", unit_idx)
-    return None
+    # check up-front rather than catching the KeyError: avoids creating a context
+    # manager and raising an exception on each call for files without the column
+    if "obs_intervals" not in nwb['units']:
+        return None
+    return get_indexed_units_column(nwb, "obs_intervals", unit_idx)
 
 def get_indexed_units_column(nwb: LazyFile, column: str, unit_idx: int) -> Any:
-    if column not in nwb.units:
-        raise KeyError(f"Column {column!r} not found in units table")
-    index_column = f"{column}_index"
-    if unit_idx == 0:
-        start_idx = 0
-    else:
-        start_idx = nwb.units.get(index_column)[unit_idx - 1].item()
-    end_idx = nwb.units.get(index_column)[unit_idx].item()
+    data, index = _get_indexed_units_datasets(nwb, column)
+    ends = _get_index_values(index)
+    if not -len(ends) <= unit_idx < len(ends):
+        raise IndexError(f"Unit index {unit_idx} out of range for units table with {len(ends)} units")
+    if unit_idx < 0:
+        unit_idx += len(ends)
+    start_idx = ends[unit_idx - 1].item() if unit_idx > 0 else 0
+    end_idx = ends[unit_idx].item()
     assert start_idx < end_idx, f"{start_idx=} >= {end_idx=}"
-    return nwb.units.get(column)[start_idx:end_idx]
+    return data[start_idx:end_idx]
+
+def _get_indexed_units_datasets(nwb: LazyFile, column: str) -> tuple[h5py.Dataset | zarr.Array, h5py.Dataset | zarr.Array]:
+    """Get the data and index datasets for an indexed column in the units table.
+
+    - components are cached on the LazyFile after the first lookup, so repeated
+      calls (e.g. for each unit in turn) return the same objects without looking
+      them up in the file again
+    """
+    units = nwb.units
+    datasets = []
+    for name in (column, f"{column}_index"):
+        dataset = getattr(units, name, None)
+        # attribute access also finds properties of the underlying group (e.g.
+        # `name`, `attrs`), which aren't columns
+        if not (isinstance(dataset, h5py.Dataset) or lazynwb.file_io.is_zarr_array(dataset)):
+            raise KeyError(f"Column {name!r} not found in units table")
+        datasets.append(dataset)
+    data, index = datasets
+    return data, index
+
+_index_values: dict[int, npt.NDArray[np.int64]] = {}
+
+def _get_index_values(index: h5py.Dataset | zarr.Array) -> npt.NDArray[np.int64]:
+    """Get all values in an index column, read once and then cached for as long
+    as the dataset object exists.
+
+    - the index is needed on every call to get a unit's data, e.g. in a loop
+      over `get_spike_times`, and is small compared to the data it indexes
+    """
+    # keyed by identity: zarr arrays aren't hashable
+    key = id(index)
+    values = _index_values.get(key)
+    if values is None:
+        values = np.asarray(index[:], dtype=np.int64)
+        _index_values[key] = values
+        weakref.finalize(index, _index_values.pop, key, None)
+    return values
+
+def get_indexed_units_column_data(nwb: LazyFile, column: str, unit_indices: Iterable[int]) -> list[npt.NDArray]:
+    """
+    Get the data in an indexed column (e.g. `spike_times`) for multiple units,
+    from their indices in the units table. Returns one array per unit index, in
+    the order requested.
+    
+    - much faster than calling `get_indexed_units_column` for each unit: the
+      index column is read once, and the data for units that are adjacent (or
+      close together) in the table is read with a single slice
+
+    Examples:
+        >>> nwb = LazyFile('s3://codeocean-s3datasetsbucket-1u41qdg42ur9/39490bff-87c9-4ef2-b408-36334e748ac6/nwb/ecephys_620264_2022-08-02_15-39-59_experiment1_recording1.nwb')
+        >>> spike_times = get_indexed_units_column_data(nwb, "spike_times", [0, 1])
+        >>> len(spike_times)
+        2
+        >>> all(spike_times[0] == get_spike_times(nwb, 0))
+        True
+        >>> all(get_indexed_units_column_data(nwb, "spike_times", [-1])[0] == get_spike_times(nwb, -1))
+        True
+        >>> get_indexed_units_column_data(nwb, "spike_times", [100_000])
+        Traceback (most recent call last):
+        ...
+        IndexError: Unit index 100000 out of range for units table with ... units
+    """
+    dataset, index = _get_indexed_units_datasets(nwb, column)
+    ends = _get_index_values(index)
+    unit_indices = np.asarray(unit_indices, dtype=np.int64)
+    # negative indices count from the end, as in `get_indexed_units_column`
+    out_of_range = (unit_indices < -len(ends)) | (unit_indices >= len(ends))
+    if out_of_range.any():
+        raise IndexError(f"Unit index {unit_indices[out_of_range][0]} out of range for units table with {len(ends)} units")
+    # each unit's data is read once, in file order
+    unique_indices, inverse = np.unique(unit_indices % max(len(ends), 1), return_inverse=True)
+    # each unit's data starts where the previous unit's ends (the first starts at 0)
+    stops = ends[unique_indices]
+    starts = np.where(unique_indices > 0, ends[unique_indices - 1], 0)
+    lengths = stops - starts
+    # fancy-indexing reads element-by-element: contiguous slices are read as whole
+    # chunks, and units separated by a small gap are read together, as reading a
+    # few unneeded values is cheaper than another request
+    slices = _get_contiguous_slices(starts, lengths, max_gap=_MAX_SLICE_GAP)
+    if lazynwb.file_io.is_zarr_array(dataset):
+        blocks = _read_zarr_slices(dataset, slices)
+    else:
+        blocks = [dataset[s] for s in slices]
+    # views into the blocks read, sliced directly: np.split has a lot of overhead
+    # per piece when there are many short runs
+    empty = np.empty((0, *dataset.shape[1:]), dtype=dataset.dtype)
+    unit_values = [empty] * len(unique_indices)
+    block_starts = [s.start for s in slices]
+    block_indices = np.searchsorted(block_starts, starts, side='right') - 1
+    for i, (block_idx, start, length) in enumerate(zip(block_indices.tolist(), starts.tolist(), lengths.tolist())):
+        if length:
+            offset = start - block_starts[block_idx]
+            unit_values[i] = blocks[block_idx][offset:offset + length]
+    return [unit_values[i] for i in inverse.tolist()]
+
+def _read_zarr_slices(array: zarr.Array, slices: list[slice]) -> list[npt.NDArray]:
+    """Read slices of a zarr array concurrently, each split into chunk-aligned
+    pieces of around `DEFAULT_BLOCK_SIZE` bytes.
+
+    - zarr reads are thread-safe, and chunks are fetched and decompressed without
+      holding the GIL: a large slice (e.g. all spike times) would otherwise be read
+      one chunk after another
+    """
+    chunk_len = array.chunks[0]
+    chunk_nbytes = max(1, array.nbytes // max(1, array.shape[0]) * chunk_len)
+    piece_len = chunk_len * max(1, lazynwb.file_handlers.DEFAULT_BLOCK_SIZE // chunk_nbytes)
+    pieces = [_split_slice(s, piece_len) for s in slices]
+    values = iter(_get_column_executor().map(array.__getitem__, [p for s in pieces for p in s]))
+    return [
+        next(values) if len(s) == 1 else np.concatenate([next(values) for _ in s])
+        for s in pieces
+    ]
+
+def _split_slice(s: slice, step: int) -> list[slice]:
+    """Split a slice at multiples of `step`.
+
+    >>> _split_slice(slice(5, 25), 10)
+    [slice(5, 10, None), slice(10, 20, None), slice(20, 25, None)]
+    """
+    boundaries = [s.start, *range(s.start - s.start % step + step, s.stop, step), s.stop]
+    return [slice(a, b) for a, b in zip(boundaries[:-1], boundaries[1:])]
+
+_MAX_SLICE_GAP = 64 * 1024
+"""Units whose data is separated by fewer than this many values are read with a
+single slice."""
+
+def _get_contiguous_slices(starts: npt.NDArray[np.int64], lengths: npt.NDArray[np.int64], max_gap: int = 0) -> list[slice]:
+    """Merge sorted, non-overlapping ranges that are adjacent, or separated by up
+    to `max_gap` values, into a minimal number of slices. Empty ranges are skipped.
+
+    >>> _get_contiguous_slices(np.array([0, 3, 3, 10]), np.array([3, 0, 2, 5]))
+    [slice(0, 5, None), slice(10, 15, None)]
+    >>> _get_contiguous_slices(np.array([0, 3, 3, 10]), np.array([3, 0, 2, 5]), max_gap=5)
+    [slice(0, 15, None)]
+    >>> _get_contiguous_slices(np.array([4]), np.array([0]))
+    []
+    """
+    nonempty = lengths > 0
+    starts = starts[nonempty]
+    ends = starts + lengths[nonempty]
+    if not len(starts):
+        return []
+    breaks = np.flatnonzero(starts[1:] - ends[:-1] > max_gap) + 1
+    run_starts = starts[np.concatenate(([0], breaks))]
+    run_ends = ends[np.concatenate((breaks - 1, [-1]))]
+    return [slice(int(a), int(b)) for a, b in zip(run_starts, run_ends)]
 
 if __name__ == "__main__":
     from npc_io import testmod
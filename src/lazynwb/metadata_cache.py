@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+from typing import Any
+
+import npc_io
+import upath
+
+import lazynwb.file_io
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METADATA_CACHE_PATH = '~/.cache/lazynwb/meta.sqlite'
+
+
+def get_metadata_cache_key(path: npc_io.PathLike, **fsspec_storage_options: Any) -> str | None:
+    """
+    Get a key that identifies a specific version of a file, for looking up its
+    cached metadata. Returns None if the version can't be determined, in which
+    case the metadata should not be cached.
+
+    - the key combines the path with the ETag of a remote object, or the
+      modification time of a local file
+    - zarr stores are not cached: arrays can be rewritten individually, without
+      any change to the store's root, so no single version covers them all
+
+    Examples:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as f:
+        ...     get_metadata_cache_key(f.name).startswith(upath.UPath(f.name).as_posix())
+        True
+        >>> get_metadata_cache_key('/non-existent/file.nwb') is None
+        True
+        >>> get_metadata_cache_key(tempfile.mkdtemp()) is None     # e.g. a zarr store
+        True
+    """
+    path = lazynwb.file_io.get_upath(path, **fsspec_storage_options)
+    try:
+        info = path.fs.info(path.path)
+    except (OSError, ValueError):
+        return None
+    if info.get('type') == 'directory':
+        return None
+    version = _get_version(info)
+    if version is None:
+        return None
+    return f"{path.as_posix()}@{version}"
+
+
+def _get_version(info: dict[str, Any]) -> str | None:
+    for field in ('ETag', 'mtime', 'LastModified', 'last_modified'):
+        if info.get(field) is not None:
+            return str(info[field]).strip('"')
+    return None
+
+
+def read_metadata_cache(key: str, cache_path: npc_io.PathLike = DEFAULT_METADATA_CACHE_PATH) -> dict[str, Any] | None:
+    """Get the metadata previously stored for `key`, or None if there isn't any."""
+    db_path = _get_db_path(cache_path)
+    if not os.path.exists(db_path):
+        return None
+    try:
+        with contextlib.closing(_connect(db_path)) as conn:
+            row = conn.execute("SELECT data FROM metadata WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as exc:
+        logger.warning(f"failed to read metadata cache at {db_path}: {exc!r}")
+        return None
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def write_metadata_cache(key: str, data: dict[str, Any], cache_path: npc_io.PathLike = DEFAULT_METADATA_CACHE_PATH) -> None:
+    """Store json-serializable metadata for `key`, replacing any previous entry.
+
+    - failures are logged but not raised: the cache is an optimization only
+    """
+    db_path = _get_db_path(cache_path)
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with contextlib.closing(_connect(db_path)) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, data) VALUES (?, ?)",
+                (key, json.dumps(data)),
+            )
+    except (OSError, sqlite3.Error) as exc:
+        logger.warning(f"failed to write metadata cache at {db_path}: {exc!r}")
+
+
+def clear_metadata_cache(cache_path: npc_io.PathLike = DEFAULT_METADATA_CACHE_PATH) -> None:
+    """Delete all cached metadata."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(_get_db_path(cache_path))
+
+
+def _get_db_path(cache_path: npc_io.PathLike) -> str:
+    return os.path.expanduser(os.fspath(cache_path))
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    return conn
+
+
+if __name__ == "__main__":
+    from npc_io import testmod
+
+    testmod()